@@ -1,30 +1,52 @@
+import asyncio
+import logging
 import os
+import queue
 import re
-import uuid
+import secrets
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from contextlib import asynccontextmanager
 from html import escape
+from logging.handlers import QueueHandler, QueueListener
 
 import anyio
+import httpx
+import orjson
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
 
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    LinkPreviewOptions,
+    Message,
 )
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     ConversationHandler,
+    Defaults,
     MessageHandler,
+    PersistenceInput,
+    PicklePersistence,
     filters,
 )
 
-from yookassa import Configuration, Payment
-from supabase import create_client
+from supabase import ClientOptions, create_client
+from postgrest.types import CountMethod, ReturnMethod
+
+
+log = logging.getLogger("bot")
 
 
 # ----------------------------
@@ -35,18 +57,26 @@ def e(s: str) -> str:
     return escape(s or "", quote=False)
 
 
+# 1) уже со схемой  2) telegra.ph/ или www.  3) есть точка и нет пробелов
+_URL_RE = re.compile(r"(https?://.*)|(?:telegra\.ph/|www\.).*|[^ ]*\.[^ ]*", re.DOTALL)
+
+
 def normalize_url(url: str) -> str:
     """Make URL Telegram-valid. Returns '' if can't be normalized."""
     u = (url or "").strip()
-    if not u:
+    m = _URL_RE.fullmatch(u)
+    if not m:
         return ""
-    if u.startswith(("http://", "https://")):
-        return u
-    if u.startswith(("telegra.ph/", "www.")):
-        return "https://" + u
-    if "." in u and " " not in u:
-        return "https://" + u
-    return ""
+    return u if m.group(1) else "https://" + u
+
+
+def read_asset(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except Exception as ex:
+        log.warning("[asset] %s error: %r", path, ex)
+        return None
 
 
 def _require(name: str, value: str) -> None:
@@ -59,45 +89,78 @@ DB_TIMEOUT_SEC = float(os.getenv("DB_TIMEOUT_SEC", "6.0"))
 EDIT_TIMEOUT_SEC = float(os.getenv("EDIT_TIMEOUT_SEC", "6.0"))
 YK_TIMEOUT_SEC = float(os.getenv("YK_TIMEOUT_SEC", "12.0"))
 
-# Не обрабатывать апдейты параллельно (важно для стабильности)
-MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "1"))
+# Сколько апдейтов из update_queue PTB обрабатывает одновременно (в разных чатах; внутри чата — по очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "256"))
 
 # Админ(ы)
 ADMIN_TELEGRAM_ID_RAW = os.getenv("ADMIN_TELEGRAM_ID", "").strip()  # "123" or "123,456"
-ADMIN_IDS: set[int] = set()
+_admin_ids: set[int] = set()
 if ADMIN_TELEGRAM_ID_RAW:
     for part in ADMIN_TELEGRAM_ID_RAW.replace(";", ",").split(","):
         part = part.strip()
         if part.isdigit():
-            ADMIN_IDS.add(int(part))
+            _admin_ids.add(int(part))
+ADMIN_IDS: frozenset[int] = frozenset(_admin_ids)
+del _admin_ids
 
 
-def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+def is_admin(user_id: int, _admin_ids: frozenset[int] = ADMIN_IDS) -> bool:
+    # ADMIN_IDS привязан как default-аргумент: без поиска по globals на каждом апдейте
+    return user_id in _admin_ids
+
+
+# Все блокирующие вызовы (Supabase) идут через этот пул — других пулов потоков в боте нет
+DB_MAX_THREADS = int(os.getenv("DB_MAX_THREADS", "20"))
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_MAX_THREADS, thread_name_prefix="db")
 
 
 async def safe_thread_call(fn, *args, default=None, timeout_sec: float = DB_TIMEOUT_SEC):
     """
-    Вызов синхронной функции в отдельном потоке + таймаут.
+    Вызов синхронной функции в потоке DB_EXECUTOR + таймаут.
     AnyIO v4: fail_after is a context manager.
     """
+    # run_in_executor не копирует contextvars — в DB-функциях они не нужны
+    loop = asyncio.get_running_loop()
     try:
         with anyio.fail_after(timeout_sec):
-            return await anyio.to_thread.run_sync(fn, *args)
+            return await loop.run_in_executor(DB_EXECUTOR, fn, *args)
     except TimeoutError:
-        print(f"[safe_thread_call] {fn.__name__} timeout after {timeout_sec}s")
+        log.warning("[safe_thread_call] %s timeout after %ss", fn.__name__, timeout_sec)
         return default
     except Exception as ex:
-        print(f"[safe_thread_call] {fn.__name__} error:", repr(ex))
+        log.warning("[safe_thread_call] %s error: %r", fn.__name__, ex)
         return default
 
 
+_background_tasks: set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """Запуск корутины в фоне; держим ссылку на задачу, пока она не завершится."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+# По одному asyncio.Lock на пользователя, пока кто-то его держит/ждёт
+_user_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+
+def user_lock(telegram_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(telegram_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[telegram_id] = lock
+    return lock
+
+
 async def safe_answer(q):
     """Всегда пытаемся быстро закрыть 'loading' у кнопки."""
     try:
         await q.answer()
     except Exception as ex:
-        print("[callback answer] error:", repr(ex))
+        log.warning("[callback answer] error: %r", ex)
 
 
 # ----------------------------
@@ -127,6 +190,20 @@ SUPPORT_TEXT_EXTRA = os.getenv("SUPPORT_TEXT_EXTRA", "").strip()
 WELCOME_IMAGE_PATH = os.getenv("WELCOME_IMAGE_PATH", "assets/welcome.png").strip()
 OFFERTA_FILE_PATH = os.getenv("OFFERTA_FILE_PATH", "assets/offerta.pdf").strip()
 
+# Содержимое файлов читается один раз в lifespan (None — файла нет)
+WELCOME_IMAGE_BYTES: bytes | None = None
+OFFERTA_BYTES: bytes | None = None
+
+# file_id Telegram после первой загрузки — дальше файл не перезаливается.
+# Можно закрепить через env (id печатается в лог при первой отправке), чтобы пережить рестарт.
+WELCOME_FILE_ID: str | None = os.getenv("WELCOME_FILE_ID", "").strip() or None
+OFFERTA_FILE_ID: str | None = os.getenv("OFFERTA_FILE_ID", "").strip() or None
+# Пока file_id нет, картинку грузит один /start — остальные ждут и берут готовый id
+_welcome_upload_lock = asyncio.Lock()
+# Загрузка упала — следующие WELCOME_UPLOAD_RETRY_SEC /start сразу отвечают текстом, а не встают в очередь к замку
+WELCOME_UPLOAD_RETRY_SEC = 60.0
+_welcome_upload_failed_at = float("-inf")
+
 PRICE_RUB = "1000.00"
 CURRENCY = "RUB"
 
@@ -142,38 +219,110 @@ _require("SUPABASE_URL", SUPABASE_URL)
 _require("SUPABASE_SERVICE_ROLE_KEY", SUPABASE_SERVICE_ROLE_KEY)
 _require("WEBHOOK_SECRET", WEBHOOK_SECRET)
 
-if PAYMENTS_ENABLED:
-    Configuration.account_id = YOOKASSA_SHOP_ID
-    Configuration.secret_key = YOOKASSA_SECRET_KEY
-
 
 # ----------------------------
 # Supabase
 # ----------------------------
-supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+# HTTP-таймаут PostgREST = DB_TIMEOUT_SEC: поток не висит дольше, чем его ждёт safe_thread_call.
+# Пул httpx.Client по умолчанию (100 соединений, 20 keep-alive) покрывает все DB-потоки.
+supabase = create_client(
+    SUPABASE_URL,
+    SUPABASE_SERVICE_ROLE_KEY,
+    options=ClientOptions(schema="public", postgrest_client_timeout=DB_TIMEOUT_SEC),
+)
+
+
+# Записи не читают ответ: return=minimal — PostgREST не сериализует строку обратно
+def db_upsert_started(rows: list[dict]) -> bool:
+    supabase.table("tg_users").upsert(
+        rows, on_conflict="telegram_id", returning=ReturnMethod.minimal
+    ).execute()
+    return True
+
+
+# /start пишем пачками: один upsert на до START_BATCH_SIZE пользователей
+START_BATCH_SIZE = int(os.getenv("START_BATCH_SIZE", "200"))
+START_BATCH_DELAY_SEC = float(os.getenv("START_BATCH_DELAY_SEC", "0.5"))
+# Пачка не записалась — строки возвращаются в буфер и пробуются снова через столько секунд
+START_RETRY_DELAY_SEC = float(os.getenv("START_RETRY_DELAY_SEC", "5"))
+
+# telegram_id -> строка; повторный /start того же пользователя перезаписывает, а не копится
+_start_buf: dict[int, dict] = {}
+_start_flush_scheduled = False
 
+# Повторный /start того же пользователя в пределах START_DEDUP_TTL_SEC в базу не пишем
+START_DEDUP_TTL_SEC = float(os.getenv("START_DEDUP_TTL_SEC", "600"))
+START_DEDUP_MAX = 10_000
+_recent_starts: OrderedDict[int, float] = OrderedDict()
 
-def db_upsert_started(telegram_id: int, username: str | None) -> None:
+
+def queue_started(telegram_id: int, username: str | None) -> None:
+    global _start_flush_scheduled
+    ts = time.monotonic()
+    seen = _recent_starts.get(telegram_id)
+    if seen is not None and ts - seen < START_DEDUP_TTL_SEC:
+        return
+
+    _start_buf[telegram_id] = {"telegram_id": telegram_id, "username": username}
+    if len(_start_buf) >= START_BATCH_SIZE:
+        spawn(flush_started())
+    elif not _start_flush_scheduled:
+        _start_flush_scheduled = True
+        spawn(_flush_started_later())
+
+
+async def _flush_started_later(delay: float = START_BATCH_DELAY_SEC) -> None:
+    global _start_flush_scheduled
+    await anyio.sleep(delay)
+    _start_flush_scheduled = False
+    await flush_started()
+
+
+async def flush_started() -> None:
+    global _start_flush_scheduled
+    if not _start_buf:
+        return
+    rows = list(_start_buf.values())
+    _start_buf.clear()
+    # Одна метка на пачку: окно батча меньше секунды, точнее started_at не нужен
     now = datetime.now(timezone.utc).isoformat()
-    payload = {"telegram_id": telegram_id, "username": username, "started_at": now}
-    supabase.table("tg_users").upsert(payload, on_conflict="telegram_id").execute()
+    for row in rows:
+        row["started_at"] = now
+    if await safe_thread_call(db_upsert_started, rows, default=False):
+        # Дедуп отмечаем только после записи: упавшая пачка не должна глушить повторный /start
+        ts = time.monotonic()
+        for row in rows:
+            _recent_starts[row["telegram_id"]] = ts
+            _recent_starts.move_to_end(row["telegram_id"])
+        while len(_recent_starts) > START_DEDUP_MAX:
+            _recent_starts.popitem(last=False)
+        return
+    # Не записалось — возвращаем в буфер (если пользователь не успел нажать /start заново) и повторяем позже
+    for row in rows:
+        _start_buf.setdefault(row["telegram_id"], row)
+    if not _start_flush_scheduled:
+        _start_flush_scheduled = True
+        spawn(_flush_started_later(START_RETRY_DELAY_SEC))
 
 
-def db_set_customer_email(telegram_id: int, email: str) -> None:
+# Запись в tg_users возвращает записанные поля — write_user дописывает их в кэш
+def db_set_customer_email(telegram_id: int, email: str) -> dict:
+    payload = {"telegram_id": telegram_id, "customer_email": email}
     supabase.table("tg_users").upsert(
-        {"telegram_id": telegram_id, "customer_email": email},
-        on_conflict="telegram_id",
+        payload, on_conflict="telegram_id", returning=ReturnMethod.minimal
     ).execute()
+    return payload
 
 
-def db_set_last_payment(telegram_id: int, payment_id: str) -> None:
+def db_set_last_payment(telegram_id: int, payment_id: str) -> dict:
+    payload = {"telegram_id": telegram_id, "last_payment_id": payment_id}
     supabase.table("tg_users").upsert(
-        {"telegram_id": telegram_id, "last_payment_id": payment_id},
-        on_conflict="telegram_id",
+        payload, on_conflict="telegram_id", returning=ReturnMethod.minimal
     ).execute()
+    return payload
 
 
-def db_mark_paid(telegram_id: int, payment_id: str, invite_link: str | None = None) -> None:
+def db_mark_paid(telegram_id: int, payment_id: str, invite_link: str | None = None) -> dict:
     now = datetime.now(timezone.utc).isoformat()
     payload = {
         "telegram_id": telegram_id,
@@ -183,7 +332,10 @@ def db_mark_paid(telegram_id: int, payment_id: str, invite_link: str | None = No
     }
     if invite_link:
         payload["invite_link"] = invite_link
-    supabase.table("tg_users").upsert(payload, on_conflict="telegram_id").execute()
+    supabase.table("tg_users").upsert(
+        payload, on_conflict="telegram_id", returning=ReturnMethod.minimal
+    ).execute()
+    return payload
 
 
 def db_get_user(telegram_id: int) -> dict | None:
@@ -198,32 +350,82 @@ def db_get_user(telegram_id: int) -> dict | None:
     return data[0] if data else None
 
 
-def db_list_paid_user_ids() -> list[int]:
-    res = supabase.table("tg_users").select("telegram_id").eq("paid", True).execute()
-    rows = res.data or []
-    out: list[int] = []
-    for r in rows:
-        try:
-            out.append(int(r.get("telegram_id")))
-        except Exception:
-            pass
-    return out
+# Кэш строк tg_users: повторные нажатия pay/check не ходят в Supabase.
+# Запись через write_user дописывает поля в строку кэша (на event loop, не в потоке БД).
+USER_CACHE_TTL_SEC = float(os.getenv("USER_CACHE_TTL_SEC", "30"))
+# paid=True уже не откатывается — такие строки держим дольше
+USER_CACHE_PAID_TTL_SEC = float(os.getenv("USER_CACHE_PAID_TTL_SEC", "3600"))
+USER_CACHE_MAX = 10_000
+
+_user_cache: OrderedDict[int, tuple[float, object]] = OrderedDict()  # строка (dict | None) или _CACHE_STALE
+# telegram_id -> (когда начат SELECT, future)
+_user_fetches: dict[int, tuple[float, asyncio.Future]] = {}
+_CACHE_MISS = object()
+# Строки в кэше нет, но была запись — перечитать; заодно не даёт залить снимок из SELECT, начатого до записи
+_CACHE_STALE = object()
+
+
+def _cache_fresh(hit: tuple[float, object] | None, now: float) -> bool:
+    if hit is None or hit[1] is _CACHE_STALE:
+        return False
+    ttl = USER_CACHE_PAID_TTL_SEC if hit[1] and hit[1].get("paid") else USER_CACHE_TTL_SEC
+    return now - hit[0] < ttl
+
+
+async def cached_get_user(telegram_id: int) -> dict | None:
+    now = time.monotonic()
+    hit = _user_cache.get(telegram_id)
+    if _cache_fresh(hit, now):
+        return hit[1]
+
+    # Одновременные промахи по одному пользователю ждут один и тот же SELECT
+    fetch = _user_fetches.get(telegram_id)
+    if fetch is None:
+        fetch = (now, asyncio.ensure_future(safe_thread_call(db_get_user, telegram_id, default=_CACHE_MISS)))
+        _user_fetches[telegram_id] = fetch
+        fetch[1].add_done_callback(lambda _f: _user_fetches.pop(telegram_id, None))
+    started, future = fetch
+    row = await asyncio.shield(future)
+    if row is _CACHE_MISS:
+        # ошибка/таймаут Supabase — не кэшируем
+        return None
+
+    hit = _user_cache.get(telegram_id)
+    if hit is not None and hit[0] > started:
+        # Пока шёл SELECT, строку обновила запись (или свежий SELECT) — старый снимок не кладём
+        return row if hit[1] is _CACHE_STALE else hit[1]
+
+    _user_cache[telegram_id] = (started, row)
+    _user_cache.move_to_end(telegram_id)
+    while len(_user_cache) > USER_CACHE_MAX:
+        _user_cache.popitem(last=False)
+    return row
+
+
+def _cache_merge(telegram_id: int, fields: dict) -> None:
+    # Запись прошла — дописываем поля в строку кэша, а не выкидываем её (следующий клик без SELECT)
+    now = time.monotonic()
+    hit = _user_cache.get(telegram_id)
+    if hit is None or hit[1] is None or not _cache_fresh(hit, now):
+        if hit is None and telegram_id not in _user_fetches:
+            return
+        # полной свежей строки у нас нет (или она истекла — её могли поменять в базе руками) — пусть перечитается
+        _user_cache[telegram_id] = (now, _CACHE_STALE)
+        return
+    _user_cache[telegram_id] = (now, {**hit[1], **fields})
 
 
-def db_list_unpaid_user_ids() -> list[int]:
-    # unpaid = paid is NULL or paid = false
-    try:
-        res = (
-            supabase.table("tg_users")
-            .select("telegram_id")
-            .or_("paid.is.null,paid.eq.false")
-            .execute()
-        )
-    except Exception:
-        # fallback
-        res = supabase.table("tg_users").select("telegram_id").execute()
+async def write_user(fn, telegram_id: int, *args) -> None:
+    """Запись в tg_users в потоке БД; записанные поля попадают в кэш уже на event loop."""
+    fields = await safe_thread_call(fn, telegram_id, *args)
+    if fields is not None:
+        _cache_merge(telegram_id, fields)
+
+
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", "10000"))
+
 
-    rows = res.data or []
+def _parse_user_ids(rows: list[dict]) -> list[int]:
     out: list[int] = []
     for r in rows:
         try:
@@ -233,11 +435,78 @@ def db_list_unpaid_user_ids() -> list[int]:
     return out
 
 
+def db_count_paid_users() -> int:
+    res = (
+        supabase.table("tg_users")
+        .select("telegram_id", count=CountMethod.exact, head=True)
+        .eq("paid", True)
+        .execute()
+    )
+    return res.count or 0
+
+
+def db_count_unpaid_users() -> int:
+    res = (
+        supabase.table("tg_users")
+        .select("telegram_id", count=CountMethod.exact, head=True)
+        .or_("paid.is.null,paid.eq.false")
+        .execute()
+    )
+    return res.count or 0
+
+
+def _user_ids_page(query, after_id: int | None, page: int) -> list[dict]:
+    # keyset-пагинация по первичному ключу: без OFFSET, каждая страница — индексный range scan
+    if after_id is not None:
+        query = query.gt("telegram_id", after_id)
+    return query.order("telegram_id").limit(page).execute().data or []
+
+
+def db_paid_user_ids_page(after_id: int | None, page: int = DB_PAGE_SIZE) -> list[dict]:
+    """One page (up to `page` rows) of paid users with telegram_id > after_id."""
+    return _user_ids_page(supabase.table("tg_users").select("telegram_id").eq("paid", True), after_id, page)
+
+
+def db_unpaid_user_ids_page(after_id: int | None, page: int = DB_PAGE_SIZE) -> list[dict]:
+    """One page (up to `page` rows) of unpaid users with telegram_id > after_id."""
+    # unpaid = paid is NULL or paid = false; ошибку не глушим — её повторит/прервёт цикл рассылки
+    return _user_ids_page(
+        supabase.table("tg_users").select("telegram_id").or_("paid.is.null,paid.eq.false"),
+        after_id,
+        page,
+    )
+
+
 # ----------------------------
 # YooKassa (with receipt)
 # ----------------------------
-def yk_create_payment(telegram_id: int, customer_email: str) -> tuple[str, str]:
-    idem_key = str(uuid.uuid4())
+YK_API_URL = "https://api.yookassa.ru/v3"
+YK_AUTH = (YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY)
+# 202 «ещё обрабатывается»: повторяем POST с тем же Idempotence-Key, как делал SDK
+YK_PROCESSING_ATTEMPTS = int(os.getenv("YK_PROCESSING_ATTEMPTS", "3"))
+
+# Один keep-alive клиент на процесс: TLS к ЮKassa не переустанавливается на каждый платёж.
+# Закрывается в lifespan.
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+    timeout=httpx.Timeout(YK_TIMEOUT_SEC),
+    http2=True,
+)
+
+
+def _yk_json(r: httpx.Response) -> dict:
+    # Ошибку показываем текстом ЮKassa (description), а не общим «Client error '400 ...'» от httpx
+    if r.is_success:
+        return orjson.loads(r.content)
+    try:
+        description = orjson.loads(r.content).get("description")
+    except Exception:
+        description = None
+    raise RuntimeError(f"YooKassa: {description or f'HTTP {r.status_code}'}")
+
+
+async def yk_create_payment(telegram_id: int, customer_email: str) -> tuple[str, str]:
+    idem_key = secrets.token_hex(16)
     payment_data = {
         "amount": {"value": PRICE_RUB, "currency": CURRENCY},
         "confirmation": {"type": "redirect", "return_url": "https://ai-sistems-tgcurse.ru/"},
@@ -262,15 +531,21 @@ def yk_create_payment(telegram_id: int, customer_email: str) -> tuple[str, str]:
         },
     }
 
-    payment = Payment.create(payment_data, idem_key)
-    payment_id = getattr(payment, "id", None) or payment.get("id")
-    confirmation = getattr(payment, "confirmation", None) or payment.get("confirmation")
-
-    confirmation_url = None
-    if hasattr(confirmation, "confirmation_url"):
-        confirmation_url = confirmation.confirmation_url
-    elif isinstance(confirmation, dict):
-        confirmation_url = confirmation.get("confirmation_url")
+    for attempt in range(YK_PROCESSING_ATTEMPTS):
+        r = await http_client.post(
+            f"{YK_API_URL}/payments",
+            json=payment_data,
+            auth=YK_AUTH,
+            headers={"Idempotence-Key": idem_key},
+        )
+        payment = _yk_json(r)
+        if r.status_code != 202:
+            break
+        if attempt + 1 < YK_PROCESSING_ATTEMPTS:
+            # retry_after — в миллисекундах; общий срок всё равно ограничен fail_after у вызывающего
+            await anyio.sleep((payment.get("retry_after") or 1800) / 1000)
+    payment_id = payment.get("id")
+    confirmation_url = (payment.get("confirmation") or {}).get("confirmation_url")
 
     if not payment_id or not confirmation_url:
         raise RuntimeError("YooKassa: failed to create payment / no confirmation_url")
@@ -278,12 +553,25 @@ def yk_create_payment(telegram_id: int, customer_email: str) -> tuple[str, str]:
     return payment_id, confirmation_url
 
 
-def yk_get_status(payment_id: str) -> str:
-    payment = Payment.find_one(payment_id)
-    status = getattr(payment, "status", None) or payment.get("status")
+async def yk_get_status(payment_id: str) -> str:
+    r = await http_client.get(f"{YK_API_URL}/payments/{payment_id}", auth=YK_AUTH)
+    status = _yk_json(r).get("status")
     return str(status or "").lower().strip()
 
 
+_status_fetches: dict[str, asyncio.Future] = {}
+
+
+async def yk_get_status_shared(payment_id: str) -> str:
+    # Повторные нажатия «Проверить оплату» ждут уже идущий запрос к ЮKassa, а не шлют свой
+    fetch = _status_fetches.get(payment_id)
+    if fetch is None:
+        fetch = asyncio.ensure_future(yk_get_status(payment_id))
+        _status_fetches[payment_id] = fetch
+        fetch.add_done_callback(lambda _f: _status_fetches.pop(payment_id, None))
+    return await asyncio.shield(fetch)
+
+
 # ----------------------------
 # Texts (HTML)
 # ----------------------------
@@ -314,50 +602,64 @@ PAYMENTS_DISABLED_CAPTION = (
     "Скоро включим оплату — и всё заработает автоматически."
 )
 
+# SUPPORT_TEXT_EXTRA задаётся env — склеиваем один раз
+SUPPORT_CAPTION_FULL = SUPPORT_CAPTION + ("\n\n" + e(SUPPORT_TEXT_EXTRA) if SUPPORT_TEXT_EXTRA else "")
+
 POLICIES_CAPTION = "🔐 <b>Политики</b>"
 
+PAY_CAPTION = (
+    "💳 <b>Оплата курса</b>\n\n"
+    "1) Нажми «Перейти к оплате» и оплати 1000₽.\n"
+    "2) Вернись сюда и нажми «Проверить оплату».\n\n"
+    "После успешной оплаты я дам ссылку на вход в группу (доступ навсегда)."
+)
+
 NEED_EMAIL_CAPTION = (
     "📧 <b>Нужен email для чека</b>\n\n"
     "Отправь, пожалуйста, свой email одним сообщением (пример: name@gmail.com)."
 )
 
-EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+PAYMENT_PENDING_CAPTION = (
+    "⏳ Платёж ещё не завершён.\n"
+    "Если ты уже оплатил(а), подожди 10–30 секунд и нажми «Проверить оплату» ещё раз."
+)
+
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+_email_fullmatch = EMAIL_RE.fullmatch
 
 
 # ----------------------------
 # Keyboards
 # ----------------------------
-def main_keyboard(is_admin_user: bool = False) -> InlineKeyboardMarkup:
-    rows = [
-        [InlineKeyboardButton("💳 Оплатить курс — 1000₽", callback_data="pay")],
-        [InlineKeyboardButton("📚 О курсе", callback_data="about")],
-        [InlineKeyboardButton("🆘 Поддержка", callback_data="support")],
-        [InlineKeyboardButton("🔐 Политики", callback_data="policies")],
-        [InlineKeyboardButton("📄 Оферта", callback_data="offer")],
-    ]
-    if is_admin_user:
-        rows.append([InlineKeyboardButton("📣 Рассылка (админ)", callback_data="admin_broadcast")])
-    return InlineKeyboardMarkup(rows)
-
-
-def back_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
-
-
-def about_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton("Подробнее на сайте", url="https://ai-sistems-tgcurse.ru/")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back")],
-        ]
-    )
+# Клавиатуры не зависят от пользователя — собираем один раз при импорте
+_BACK_BTN = InlineKeyboardButton("⬅️ Назад", callback_data="back")
+_CHECK_BTN = InlineKeyboardButton("✅ Проверить оплату", callback_data="check")
+
+_MAIN_ROWS = [
+    [InlineKeyboardButton("💳 Оплатить курс — 1000₽", callback_data="pay")],
+    [InlineKeyboardButton("📚 О курсе", callback_data="about")],
+    [InlineKeyboardButton("🆘 Поддержка", callback_data="support")],
+    [InlineKeyboardButton("🔐 Политики", callback_data="policies")],
+    [InlineKeyboardButton("📄 Оферта", callback_data="offer")],
+]
+MAIN_KB = InlineKeyboardMarkup(_MAIN_ROWS)
+MAIN_KB_ADMIN = InlineKeyboardMarkup(
+    _MAIN_ROWS + [[InlineKeyboardButton("📣 Рассылка (админ)", callback_data="admin_broadcast")]]
+)
 
+BACK_KB = InlineKeyboardMarkup([[_BACK_BTN]])
+SUPPORT_KB = BACK_KB
+PAY_DISABLED_KB = BACK_KB
 
-def support_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
+ABOUT_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("Подробнее на сайте", url="https://ai-sistems-tgcurse.ru/")],
+        [_BACK_BTN],
+    ]
+)
 
 
-def policies_keyboard() -> InlineKeyboardMarkup:
+def _build_policies_keyboard() -> InlineKeyboardMarkup:
     p1 = normalize_url(PRIVACY_URL)
     p2 = normalize_url(DATA_POLICY_URL)
     rows = []
@@ -365,168 +667,230 @@ def policies_keyboard() -> InlineKeyboardMarkup:
         rows.append([InlineKeyboardButton("Политика конфиденциальности", url=p1)])
     if p2:
         rows.append([InlineKeyboardButton("Политика обработки данных", url=p2)])
-    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data="back")])
+    rows.append([_BACK_BTN])
     return InlineKeyboardMarkup(rows)
 
 
-def pay_keyboard_disabled() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="back")]])
+POLICIES_KB = _build_policies_keyboard()
 
+CHECK_KB = InlineKeyboardMarkup([[_CHECK_BTN], [_BACK_BTN]])
 
-def pay_keyboard_enabled(pay_url: str) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton("🔗 Перейти к оплате", url=pay_url)],
-            [InlineKeyboardButton("✅ Проверить оплату", callback_data="check")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back")],
-        ]
-    )
+ADMIN_BROADCAST_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("✅ Оплатили", callback_data="broadcast_paid")],
+        [InlineKeyboardButton("❌ Не оплатили", callback_data="broadcast_unpaid")],
+        [_BACK_BTN],
+    ]
+)
 
+ADMIN_CANCEL_KB = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="broadcast_cancel")]])
 
-def check_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton("✅ Проверить оплату", callback_data="check")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back")],
-        ]
-    )
+BROADCAST_CONFIRM_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("🚀 Отправить", callback_data="broadcast_send")],
+        [InlineKeyboardButton("❌ Отмена", callback_data="broadcast_cancel")],
+    ]
+)
+
+
+def main_keyboard(is_admin_user: bool = False) -> InlineKeyboardMarkup:
+    return MAIN_KB_ADMIN if is_admin_user else MAIN_KB
 
 
-def admin_broadcast_keyboard() -> InlineKeyboardMarkup:
+def pay_keyboard_enabled(pay_url: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [
-            [InlineKeyboardButton("✅ Оплатили", callback_data="broadcast_paid")],
-            [InlineKeyboardButton("❌ Не оплатили", callback_data="broadcast_unpaid")],
-            [InlineKeyboardButton("⬅️ Назад", callback_data="back")],
+            [InlineKeyboardButton("🔗 Перейти к оплате", url=pay_url)],
+            [_CHECK_BTN],
+            [_BACK_BTN],
         ]
     )
 
 
-def admin_cancel_keyboard() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data="broadcast_cancel")]])
-
-
 # ----------------------------
 # UI helper (caption OR text)
 # ----------------------------
+# Что сейчас показано в сообщении: (chat_id, message_id) -> (text, keyboard).
+# Повторное нажатие той же кнопки не ходит в Telegram ради "message is not modified".
+RENDERED_CACHE_MAX = 10_000
+_rendered: OrderedDict[tuple[int, int], tuple[str, InlineKeyboardMarkup]] = OrderedDict()
+
+
+def _remember_rendered(key: tuple[int, int], text: str, keyboard: InlineKeyboardMarkup) -> None:
+    _rendered[key] = (text, keyboard)
+    _rendered.move_to_end(key)
+    if len(_rendered) > RENDERED_CACHE_MAX:
+        _rendered.popitem(last=False)
+
+
 async def edit_main_message(q, text: str, keyboard: InlineKeyboardMarkup):
     msg = q.message
+    if not isinstance(msg, Message):
+        log.warning("[edit_main_message] message is inaccessible")
+        return
 
-    # 1) Try edit caption if this message has caption (photo)
-    try:
-        if getattr(msg, "caption", None) is not None:
-            with anyio.fail_after(EDIT_TIMEOUT_SEC):
-                await msg.edit_caption(caption=text, parse_mode="HTML", reply_markup=keyboard)
-            return
-    except Exception as ex:
-        print("[edit_caption html] error:", repr(ex))
+    key = (msg.chat_id, msg.message_id)
+    if _rendered.get(key) == (text, keyboard):
+        return
 
-    # 2) Try edit text if it's a text message
-    try:
-        if getattr(msg, "text", None) is not None:
-            with anyio.fail_after(EDIT_TIMEOUT_SEC):
-                await msg.edit_text(
-                    text=text,
-                    parse_mode="HTML",
-                    reply_markup=keyboard,
-                    disable_web_page_preview=True,
-                )
-            return
-    except Exception as ex:
-        print("[edit_text html] error:", repr(ex))
+    # Тип сообщения определяем один раз: фото (caption) или текст
+    if msg.caption is not None or msg.photo:
+        edit = msg.edit_caption
+        field = "caption"
+    else:
+        edit = msg.edit_text
+        field = "text"
 
-    # 3) Fallback without HTML
+    # 1) HTML
     try:
-        if getattr(msg, "caption", None) is not None:
-            with anyio.fail_after(EDIT_TIMEOUT_SEC):
-                await msg.edit_caption(caption=e(text), reply_markup=keyboard)
+        with anyio.fail_after(EDIT_TIMEOUT_SEC):
+            await edit(**{field: text}, reply_markup=keyboard)
+        _remember_rendered(key, text, keyboard)
+        return
+    except BadRequest as ex:
+        # Повторное нажатие той же кнопки — менять нечего, фолбэки не нужны
+        if "not modified" in str(ex).lower():
+            _remember_rendered(key, text, keyboard)
             return
+        log.warning("[edit html] error: %r", ex)
     except Exception as ex:
-        print("[edit_caption plain] error:", repr(ex))
+        log.warning("[edit html] error: %r", ex)
 
+    # 2) Fallback without HTML — экранируем только здесь, в штатном пути e() не вызывается
     try:
-        if getattr(msg, "text", None) is not None:
-            with anyio.fail_after(EDIT_TIMEOUT_SEC):
-                await msg.edit_text(text=e(text), reply_markup=keyboard, disable_web_page_preview=True)
-            return
+        with anyio.fail_after(EDIT_TIMEOUT_SEC):
+            await edit(**{field: e(text)}, parse_mode=None, reply_markup=keyboard)
+        _remember_rendered(key, text, keyboard)
+        return
     except Exception as ex:
-        print("[edit_text plain] error:", repr(ex))
+        log.warning("[edit plain] error: %r", ex)
 
-    # 4) Last resort — just change keyboard
+    # 3) Last resort — just change keyboard. Текст на экране уже не тот, что в кэше:
+    # забываем запись, иначе возврат на прежний экран отсечётся как «без изменений»
+    _rendered.pop(key, None)
     try:
         with anyio.fail_after(EDIT_TIMEOUT_SEC):
             await msg.edit_reply_markup(reply_markup=keyboard)
     except Exception as ex:
-        print("[edit_reply_markup] error:", repr(ex))
+        log.warning("[edit_reply_markup] error: %r", ex)
 
 
 # ----------------------------
 # Handlers
 # ----------------------------
+async def _reply_welcome_photo(message: Message, kb: InlineKeyboardMarkup) -> None:
+    global WELCOME_FILE_ID
+    photo = WELCOME_FILE_ID or WELCOME_IMAGE_BYTES
+    if photo is None:
+        raise FileNotFoundError(WELCOME_IMAGE_PATH)
+    sent = await message.reply_photo(
+        photo=photo,
+        filename=os.path.basename(WELCOME_IMAGE_PATH),
+        caption=WELCOME_CAPTION,
+        reply_markup=kb,
+    )
+    if WELCOME_FILE_ID is None and sent.photo:
+        WELCOME_FILE_ID = sent.photo[-1].file_id
+        log.info("[welcome] file_id: %s", WELCOME_FILE_ID)
+
+
+def is_bad_file_id(ex: BadRequest) -> bool:
+    # Telegram отверг сам file_id (а не сеть/лимиты) — только тогда его стоит забыть
+    msg = str(ex).lower()
+    return any(s in msg for s in ("file identifier", "file_id", "file reference", "wrong padding"))
+
+
+def _welcome_upload_backoff() -> bool:
+    return time.monotonic() - _welcome_upload_failed_at < WELCOME_UPLOAD_RETRY_SEC
+
+
+async def _upload_welcome_photo(message: Message, kb: InlineKeyboardMarkup) -> bool:
+    """Первая отправка картинки (file_id ещё нет). False — загрузка недавно падала, отвечаем текстом."""
+    global _welcome_upload_failed_at
+    if _welcome_upload_backoff():
+        return False
+    async with _welcome_upload_lock:
+        # пока ждали замок, загрузка у другого /start могла упасть
+        if WELCOME_FILE_ID is None and _welcome_upload_backoff():
+            return False
+        try:
+            await _reply_welcome_photo(message, kb)
+        except Exception:
+            if WELCOME_FILE_ID is None:
+                _welcome_upload_failed_at = time.monotonic()
+            raise
+    return True
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global WELCOME_FILE_ID
     user = update.effective_user
-    await safe_thread_call(db_upsert_started, user.id, user.username)
+    queue_started(user.id, user.username)
 
     kb = main_keyboard(is_admin_user=is_admin(user.id))
     try:
-        with open(WELCOME_IMAGE_PATH, "rb") as f:
-            await update.message.reply_photo(
-                photo=f,
-                caption=WELCOME_CAPTION,
-                parse_mode="HTML",
-                reply_markup=kb,
-            )
+        if WELCOME_FILE_ID is not None:
+            await _reply_welcome_photo(update.message, kb)
+            return
+        if await _upload_welcome_photo(update.message, kb):
+            return
+    except BadRequest as ex:
+        log.warning("[welcome] image error: %r", ex)
+        if is_bad_file_id(ex):
+            # битый file_id — в следующий раз загрузим файл заново
+            WELCOME_FILE_ID = None
     except Exception as ex:
-        print("Welcome image error:", repr(ex))
-        await update.message.reply_text(
-            WELCOME_CAPTION,
-            parse_mode="HTML",
-            reply_markup=kb,
-            disable_web_page_preview=True,
-        )
+        # сеть/таймаут/flood wait — file_id рабочий, оставляем его
+        log.warning("[welcome] image error: %r", ex)
+    await update.message.reply_text(WELCOME_CAPTION, reply_markup=kb)
 
 
 async def on_about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     await safe_answer(q)
-    await edit_main_message(q, ABOUT_CAPTION, about_keyboard())
+    await edit_main_message(q, ABOUT_CAPTION, ABOUT_KB)
 
 
 async def on_support(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     await safe_answer(q)
-    caption = SUPPORT_CAPTION
-    if SUPPORT_TEXT_EXTRA:
-        caption += "\n\n" + e(SUPPORT_TEXT_EXTRA)
-    await edit_main_message(q, caption, support_keyboard())
+    await edit_main_message(q, SUPPORT_CAPTION_FULL, SUPPORT_KB)
 
 
 async def on_policies(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     q = update.callback_query
     await safe_answer(q)
-    await edit_main_message(q, POLICIES_CAPTION, policies_keyboard())
+    await edit_main_message(q, POLICIES_CAPTION, POLICIES_KB)
 
 
 async def on_offer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global OFFERTA_FILE_ID
     q = update.callback_query
     await safe_answer(q)
 
     try:
-        with open(OFFERTA_FILE_PATH, "rb") as f:
-            with anyio.fail_after(EDIT_TIMEOUT_SEC):
-                await context.bot.send_document(
-                    chat_id=q.message.chat_id,
-                    document=f,
-                    filename=os.path.basename(OFFERTA_FILE_PATH),
-                    caption="📄 Публичная оферта (PDF)",
-                )
-        await edit_main_message(q, "📄 Оферта отправлена файлом ниже.", back_keyboard())
+        document = OFFERTA_FILE_ID or OFFERTA_BYTES
+        if document is None:
+            raise FileNotFoundError(OFFERTA_FILE_PATH)
+        with anyio.fail_after(EDIT_TIMEOUT_SEC):
+            sent = await context.bot.send_document(
+                chat_id=q.message.chat_id,
+                document=document,
+                filename=os.path.basename(OFFERTA_FILE_PATH),
+                caption="📄 Публичная оферта (PDF)",
+            )
+        if OFFERTA_FILE_ID is None and sent.document:
+            OFFERTA_FILE_ID = sent.document.file_id
+            log.info("[offer] file_id: %s", OFFERTA_FILE_ID)
+        await edit_main_message(q, "📄 Оферта отправлена файлом ниже.", BACK_KB)
     except Exception as ex:
-        print("[offer send] error:", repr(ex))
+        log.warning("[offer send] error: %r", ex)
+        if isinstance(ex, BadRequest) and is_bad_file_id(ex):
+            OFFERTA_FILE_ID = None
         await edit_main_message(
             q,
             "❌ Не смог отправить оферту.\nПроверь, что файл есть в репозитории и путь OFFERTA_FILE_PATH верный.",
-            back_keyboard(),
+            BACK_KB,
         )
 
 
@@ -541,11 +905,11 @@ async def on_pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await safe_answer(q)
 
     if not PAYMENTS_ENABLED:
-        await edit_main_message(q, PAYMENTS_DISABLED_CAPTION, pay_keyboard_disabled())
+        await edit_main_message(q, PAYMENTS_DISABLED_CAPTION, PAY_DISABLED_KB)
         return
 
     telegram_id = q.from_user.id
-    user_row = await safe_thread_call(db_get_user, telegram_id, default=None)
+    user_row = await cached_get_user(telegram_id)
 
     if user_row and user_row.get("paid"):
         invite_link = user_row.get("invite_link") or ""
@@ -554,30 +918,42 @@ async def on_pay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             caption += f"\n\nВход в группу с курсом:\n{e(invite_link)}"
         else:
             caption += "\n\nЕсли нужна ссылка — напиши в поддержку."
-        await edit_main_message(q, caption, back_keyboard())
+        await edit_main_message(q, caption, BACK_KB)
         return
 
     customer_email = (user_row or {}).get("customer_email") if user_row else None
     if not customer_email:
         context.user_data["awaiting_email_for_payment"] = True
-        await edit_main_message(q, NEED_EMAIL_CAPTION, back_keyboard())
+        await edit_main_message(q, NEED_EMAIL_CAPTION, BACK_KB)
         return
 
     try:
         with anyio.fail_after(YK_TIMEOUT_SEC):
-            payment_id, pay_url = await anyio.to_thread.run_sync(yk_create_payment, telegram_id, customer_email)
-        await safe_thread_call(db_set_last_payment, telegram_id, payment_id)
+            payment_id, pay_url = await yk_create_payment(telegram_id, customer_email)
     except Exception as ex:
-        await edit_main_message(q, f"❌ Не получилось создать платёж.\n\n{e(str(ex))}", back_keyboard())
+        await edit_main_message(q, f"❌ Не получилось создать платёж.\n\n{e(str(ex))}", BACK_KB)
         return
 
-    caption = (
-        "💳 <b>Оплата курса</b>\n\n"
-        "1) Нажми «Перейти к оплате» и оплати 1000₽.\n"
-        "2) Вернись сюда и нажми «Проверить оплату».\n\n"
-        "После успешной оплаты я дам ссылку на вход в группу (доступ навсегда)."
-    )
-    await edit_main_message(q, caption, pay_keyboard_enabled(pay_url))
+    # Ссылку показываем сразу; last_payment_id допишется параллельно (on_check читает его позже)
+    spawn(write_user(db_set_last_payment, telegram_id, payment_id))
+
+    await edit_main_message(q, PAY_CAPTION, pay_keyboard_enabled(pay_url))
+
+
+def access_open_caption(user_row: dict) -> str:
+    invite_link = user_row.get("invite_link") or ""
+    caption = "✅ <b>Доступ уже открыт.</b>"
+    if invite_link:
+        caption += f"\n\nВход в группу:\n{e(invite_link)}"
+    else:
+        caption += "\n\nЕсли нужна ссылка — напиши в поддержку."
+    return caption
+
+
+CHECK_COOLDOWN_SEC = float(os.getenv("CHECK_COOLDOWN_SEC", "5"))
+CHECK_COOLDOWN_MAX = 10_000
+# telegram_id -> (payment_id, когда ЮKassa ответила pending)
+_pending_checks: OrderedDict[int, tuple[str, float]] = OrderedDict()
 
 
 async def on_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -585,77 +961,88 @@ async def on_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await safe_answer(q)
 
     if not PAYMENTS_ENABLED:
-        await edit_main_message(q, PAYMENTS_DISABLED_CAPTION, pay_keyboard_disabled())
+        await edit_main_message(q, PAYMENTS_DISABLED_CAPTION, PAY_DISABLED_KB)
         return
 
     telegram_id = q.from_user.id
-    user_row = await safe_thread_call(db_get_user, telegram_id, default=None)
+    user_row = await cached_get_user(telegram_id)
 
     if not user_row or not user_row.get("last_payment_id"):
         await edit_main_message(
             q,
             "Пока не вижу созданного платежа.\nНажми «Оплатить курс — 1000₽» и создай ссылку на оплату.",
-            back_keyboard(),
+            BACK_KB,
         )
         return
 
     if user_row.get("paid"):
-        invite_link = user_row.get("invite_link") or ""
-        caption = "✅ <b>Доступ уже открыт.</b>"
-        if invite_link:
-            caption += f"\n\nВход в группу:\n{e(invite_link)}"
-        else:
-            caption += "\n\nЕсли нужна ссылка — напиши в поддержку."
-        await edit_main_message(q, caption, back_keyboard())
+        await edit_main_message(q, access_open_caption(user_row), BACK_KB)
         return
 
     payment_id = user_row["last_payment_id"]
 
+    # ЮKassa только что ответила «ещё не оплачен» — повторное нажатие в пределах кулдауна не проверяем
+    pending = _pending_checks.get(telegram_id)
+    if pending is not None and pending[0] == payment_id and time.monotonic() - pending[1] < CHECK_COOLDOWN_SEC:
+        await edit_main_message(q, PAYMENT_PENDING_CAPTION, CHECK_KB)
+        return
+
     try:
         with anyio.fail_after(YK_TIMEOUT_SEC):
-            status = await anyio.to_thread.run_sync(yk_get_status, payment_id)
+            status = await yk_get_status_shared(payment_id)
     except Exception as ex:
-        await edit_main_message(q, f"❌ Не получилось проверить платёж.\n\n{e(str(ex))}", check_keyboard())
+        await edit_main_message(q, f"❌ Не получилось проверить платёж.\n\n{e(str(ex))}", CHECK_KB)
         return
 
     if status == "succeeded":
-        try:
-            with anyio.fail_after(EDIT_TIMEOUT_SEC):
-                invite = await context.bot.create_chat_invite_link(
-                    chat_id=int(COURSE_GROUP_CHAT_ID),
-                    member_limit=1,
+        # Двойное нажатие: инвайт создаёт только первый, второй видит уже отмеченную оплату
+        async with user_lock(telegram_id):
+            fresh_row = await safe_thread_call(db_get_user, telegram_id, default=None)
+            if fresh_row and fresh_row.get("paid"):
+                await edit_main_message(q, access_open_caption(fresh_row), BACK_KB)
+                return
+
+            try:
+                with anyio.fail_after(EDIT_TIMEOUT_SEC):
+                    invite = await context.bot.create_chat_invite_link(
+                        chat_id=int(COURSE_GROUP_CHAT_ID),
+                        member_limit=1,
+                    )
+                invite_link = invite.invite_link
+            except Exception as ex:
+                async with anyio.create_task_group() as tg:
+                    tg.start_soon(write_user, db_mark_paid, telegram_id, payment_id, None)
+                    tg.start_soon(
+                        edit_main_message,
+                        q,
+                        "✅ Оплата прошла!\n\n"
+                        "Но я не смог создать инвайт-ссылку автоматически.\n"
+                        "Напиши в поддержку — вручную дадим доступ.\n\n"
+                        f"{e(str(ex))}",
+                        BACK_KB,
+                    )
+                return
+
+            # Ответ пользователю не ждёт записи в базу; замок держим до конца записи,
+            # чтобы повторное нажатие уже увидело paid=True
+            async with anyio.create_task_group() as tg:
+                tg.start_soon(write_user, db_mark_paid, telegram_id, payment_id, invite_link)
+                tg.start_soon(
+                    edit_main_message,
+                    q,
+                    "✅ <b>Оплата прошла!</b>\n\n"
+                    "Вот вход в группу с курсом (доступ навсегда):\n"
+                    f"{e(invite_link)}",
+                    main_keyboard(is_admin_user=is_admin(telegram_id)),
                 )
-            invite_link = invite.invite_link
-        except Exception as ex:
-            await safe_thread_call(db_mark_paid, telegram_id, payment_id, None)
-            await edit_main_message(
-                q,
-                "✅ Оплата прошла!\n\n"
-                "Но я не смог создать инвайт-ссылку автоматически.\n"
-                "Напиши в поддержку — вручную дадим доступ.\n\n"
-                f"{e(str(ex))}",
-                back_keyboard(),
-            )
-            return
-
-        await safe_thread_call(db_mark_paid, telegram_id, payment_id, invite_link)
-
-        await edit_main_message(
-            q,
-            "✅ <b>Оплата прошла!</b>\n\n"
-            "Вот вход в группу с курсом (доступ навсегда):\n"
-            f"{e(invite_link)}",
-            main_keyboard(is_admin_user=is_admin(telegram_id)),
-        )
         return
 
     if status in ("pending", "waiting_for_capture"):
-        await edit_main_message(
-            q,
-            "⏳ Платёж ещё не завершён.\n"
-            "Если ты уже оплатил(а), подожди 10–30 секунд и нажми «Проверить оплату» ещё раз.",
-            check_keyboard(),
-        )
+        _pending_checks[telegram_id] = (payment_id, time.monotonic())
+        _pending_checks.move_to_end(telegram_id)
+        if len(_pending_checks) > CHECK_COOLDOWN_MAX:
+            _pending_checks.popitem(last=False)
+        await edit_main_message(q, PAYMENT_PENDING_CAPTION, CHECK_KB)
         return
 
     if status == "canceled":
@@ -669,44 +1056,48 @@ async def on_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await edit_main_message(
         q,
         f"Статус платежа: {e(status)}\nЕсли уверен(а), что оплатил(а), напиши в поддержку.",
-        back_keyboard(),
+        BACK_KB,
     )
 
 
 # --- email capture (after bot asks for email) ---
-async def on_text_for_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if not context.user_data.get("awaiting_email_for_payment"):
-        return
+class AwaitingEmailFilter(filters.MessageFilter):
+    """Пропускает только сообщения пользователей, от которых ждём email."""
+
+    def filter(self, message) -> bool:
+        user = message.from_user
+        if user is None:
+            return False
+        ud = telegram_app.user_data.get(user.id)
+        return bool(ud and ud.get("awaiting_email_for_payment"))
+
 
+async def on_text_for_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     email = (update.message.text or "").strip()
-    if not EMAIL_RE.match(email):
+    if not _email_fullmatch(email):
         await update.message.reply_text("❌ Это не похоже на email. Пришли в формате name@example.com")
         return
 
     context.user_data["awaiting_email_for_payment"] = False
 
     telegram_id = update.effective_user.id
-    await safe_thread_call(db_set_customer_email, telegram_id, email)
+    await write_user(db_set_customer_email, telegram_id, email)
 
     if not PAYMENTS_ENABLED:
-        await update.message.reply_text(PAYMENTS_DISABLED_CAPTION, parse_mode="HTML")
+        await update.message.reply_text(PAYMENTS_DISABLED_CAPTION)
         return
 
     try:
         with anyio.fail_after(YK_TIMEOUT_SEC):
-            payment_id, pay_url = await anyio.to_thread.run_sync(yk_create_payment, telegram_id, email)
-        await safe_thread_call(db_set_last_payment, telegram_id, payment_id)
+            payment_id, pay_url = await yk_create_payment(telegram_id, email)
     except Exception as ex:
         await update.message.reply_text(f"❌ Не получилось создать платёж.\n\n{e(str(ex))}")
         return
 
-    caption = (
-        "💳 <b>Оплата курса</b>\n\n"
-        "1) Нажми «Перейти к оплате» и оплати 1000₽.\n"
-        "2) Вернись сюда и нажми «Проверить оплату».\n\n"
-        "После успешной оплаты я дам ссылку на вход в группу (доступ навсегда)."
-    )
-    await update.message.reply_text(caption, parse_mode="HTML", reply_markup=pay_keyboard_enabled(pay_url))
+    # Ссылку показываем сразу; last_payment_id допишется параллельно (on_check читает его позже)
+    spawn(write_user(db_set_last_payment, telegram_id, payment_id))
+
+    await update.message.reply_text(PAY_CAPTION, reply_markup=pay_keyboard_enabled(pay_url))
 
 
 # ----------------------------
@@ -714,16 +1105,23 @@ async def on_text_for_email(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ----------------------------
 BCAST_CHOOSE_AUDIENCE, BCAST_ENTER_TEXT, BCAST_CONFIRM = range(3)
 
+# Лимит Telegram: ~30 сообщений в секунду на бота; запас оставляем ответам в меню во время рассылки
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "25"))
+BROADCAST_RATE_PER_SEC = float(os.getenv("BROADCAST_RATE_PER_SEC", "25"))
+# Сколько раз пробуем прочитать страницу получателей, прежде чем прервать рассылку
+BROADCAST_PAGE_ATTEMPTS = 3
+_PAGE_FAILED = object()
+
 
 async def on_admin_broadcast_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     q = update.callback_query
     await safe_answer(q)
 
     if not is_admin(q.from_user.id):
-        await edit_main_message(q, "⛔️ Нет доступа.", back_keyboard())
+        await edit_main_message(q, "⛔️ Нет доступа.", BACK_KB)
         return ConversationHandler.END
 
-    await edit_main_message(q, "📣 <b>Рассылка</b>\n\nКому отправляем?", admin_broadcast_keyboard())
+    await edit_main_message(q, "📣 <b>Рассылка</b>\n\nКому отправляем?", ADMIN_BROADCAST_KB)
     return BCAST_CHOOSE_AUDIENCE
 
 
@@ -734,7 +1132,7 @@ async def on_broadcast_choose_paid(update: Update, context: ContextTypes.DEFAULT
         return ConversationHandler.END
 
     context.user_data["bcast_paid"] = True
-    await edit_main_message(q, "✍️ Пришли текст рассылки одним сообщением.", admin_cancel_keyboard())
+    await edit_main_message(q, "✍️ Пришли текст рассылки одним сообщением.", ADMIN_CANCEL_KB)
     return BCAST_ENTER_TEXT
 
 
@@ -745,7 +1143,7 @@ async def on_broadcast_choose_unpaid(update: Update, context: ContextTypes.DEFAU
         return ConversationHandler.END
 
     context.user_data["bcast_paid"] = False
-    await edit_main_message(q, "✍️ Пришли текст рассылки одним сообщением.", admin_cancel_keyboard())
+    await edit_main_message(q, "✍️ Пришли текст рассылки одним сообщением.", ADMIN_CANCEL_KB)
     return BCAST_ENTER_TEXT
 
 
@@ -779,13 +1177,7 @@ async def on_broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         f"Текст:\n\n{text}\n\n"
         f"Отправить?"
     )
-    kb = InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton("🚀 Отправить", callback_data="broadcast_send")],
-            [InlineKeyboardButton("❌ Отмена", callback_data="broadcast_cancel")],
-        ]
-    )
-    await update.message.reply_text(preview, parse_mode="HTML", reply_markup=kb, disable_web_page_preview=True)
+    await update.message.reply_text(preview, reply_markup=BROADCAST_CONFIRM_KB)
     return BCAST_CONFIRM
 
 
@@ -798,37 +1190,83 @@ async def on_broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYPE)
     paid = bool(context.user_data.get("bcast_paid", False))
     text = context.user_data.get("bcast_text", "")
     if not text:
-        await edit_main_message(q, "Текст рассылки не найден. Начни заново.", back_keyboard())
+        await edit_main_message(q, "Текст рассылки не найден. Начни заново.", BACK_KB)
         return ConversationHandler.END
 
-    user_ids = await safe_thread_call(db_list_paid_user_ids if paid else db_list_unpaid_user_ids, default=[])
-    total = len(user_ids)
-
-    await edit_main_message(q, f"⏳ Отправляю... получателей: <b>{total}</b>", back_keyboard())
+    # Для статуса хватает COUNT(*) — ids читаются страницами уже во время рассылки
+    expected = await safe_thread_call(db_count_paid_users if paid else db_count_unpaid_users)
+    if expected is None:
+        await edit_main_message(q, "⏳ Отправляю...", BACK_KB)
+    else:
+        await edit_main_message(q, f"⏳ Отправляю... получателей: <b>{expected}</b>", BACK_KB)
 
+    total = 0
     sent = 0
     failed = 0
 
-    for uid in user_ids:
-        try:
-            with anyio.fail_after(10):
-                await context.bot.send_message(
-                    chat_id=uid,
-                    text=text,
-                    parse_mode="HTML",
-                    disable_web_page_preview=True,
-                )
-            sent += 1
-        except Exception:
-            failed += 1
-        await anyio.sleep(0.05)
-
-    summary = (
-        "✅ <b>Рассылка завершена</b>\n\n"
-        f"Получателей: <b>{total}</b>\n"
-        f"Отправлено: <b>{sent}</b>\n"
-        f"Ошибок: <b>{failed}</b>"
-    )
+    # До BROADCAST_CONCURRENCY отправок одновременно, но старт не чаще BROADCAST_RATE_PER_SEC в секунду
+    sem = anyio.Semaphore(BROADCAST_CONCURRENCY)
+    interval = 1 / BROADCAST_RATE_PER_SEC
+    next_slot = 0.0
+
+    async def _send_one(uid: int) -> None:
+        nonlocal sent, failed, next_slot
+        async with sem:
+            now = anyio.current_time()
+            delay = next_slot - now
+            next_slot = max(now, next_slot) + interval
+            if delay > 0:
+                await anyio.sleep(delay)
+            try:
+                with anyio.fail_after(10):
+                    await context.bot.send_message(chat_id=uid, text=text)
+                sent += 1
+            except Exception:
+                failed += 1
+
+    # Получатели читаются страницами: следующая страница — когда разослана текущая
+    fetch_page = db_paid_user_ids_page if paid else db_unpaid_user_ids_page
+    after_id = None
+    aborted = False
+    while True:
+        # Ошибка/таймаут базы — не «страницы кончились»: повторяем, а если не вышло — прерываем
+        for attempt in range(BROADCAST_PAGE_ATTEMPTS):
+            rows = await safe_thread_call(fetch_page, after_id, default=_PAGE_FAILED)
+            if rows is not _PAGE_FAILED:
+                break
+            if attempt + 1 < BROADCAST_PAGE_ATTEMPTS:
+                await anyio.sleep(attempt + 1)
+        if rows is _PAGE_FAILED:
+            log.warning("[broadcast] page after %s failed, aborting", after_id)
+            aborted = True
+            break
+        if not rows:
+            break
+        user_ids = _parse_user_ids(rows)
+        total += len(user_ids)
+        async with anyio.create_task_group() as tg:
+            for uid in user_ids:
+                tg.start_soon(_send_one, uid)
+        if len(rows) < DB_PAGE_SIZE:
+            break
+        after_id = rows[-1]["telegram_id"]
+
+    if aborted:
+        skipped = f"{max(expected - total, 0)}" if expected is not None else "неизвестно"
+        summary = (
+            "⚠️ <b>Рассылка прервана</b>: не удалось прочитать получателей из базы.\n\n"
+            f"Получателей обработано: <b>{total}</b>\n"
+            f"Отправлено: <b>{sent}</b>\n"
+            f"Ошибок: <b>{failed}</b>\n"
+            f"Не получили (пропущено): <b>{skipped}</b>"
+        )
+    else:
+        summary = (
+            "✅ <b>Рассылка завершена</b>\n\n"
+            f"Получателей: <b>{total}</b>\n"
+            f"Отправлено: <b>{sent}</b>\n"
+            f"Ошибок: <b>{failed}</b>"
+        )
     await edit_main_message(q, summary, main_keyboard(is_admin_user=True))
 
     context.user_data.pop("bcast_paid", None)
@@ -842,21 +1280,104 @@ async def on_broadcast_send(update: Update, context: ContextTypes.DEFAULT_TYPE)
 WEBHOOK_PATH = f"/bot/webhook/{WEBHOOK_SECRET}"
 WEBHOOK_URL = f"{PUBLIC_BASE_URL}{WEBHOOK_PATH}"
 
-telegram_app = (
+# Бот обрабатывает только сообщения и нажатия кнопок — остальные типы Telegram не шлёт
+WEBHOOK_ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+# Параллельных доставок от Telegram (по умолчанию 40); ответ webhook мгновенный, держим больше
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
+
+
+async def set_webhook(drop_pending_updates: bool) -> None:
+    await telegram_app.bot.set_webhook(
+        url=WEBHOOK_URL,
+        drop_pending_updates=drop_pending_updates,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=WEBHOOK_ALLOWED_UPDATES,
+    )
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Разные чаты обрабатываются параллельно, апдейты одного чата — строго по очереди."""
+
+    def __init__(self, max_concurrent_updates: int):
+        # Семафор PTB берётся раньше do_process_update, то есть раньше замка чата — поэтому
+        # он фактически без лимита, а настоящий лимит — свой семафор, который берётся после замка
+        super().__init__(1 << 30)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # Замок чата живёт, пока его держит/ждёт хотя бы один апдейт (как _user_locks).
+        # Отдельный словарь: id личного чата совпадает с telegram_id, а user_lock берётся внутри хендлеров
+        self._chat_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # Замок чата берём ДО общего семафора: апдейт, ждущий свой чат, не занимает глобальный слот
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        lock = self._chat_locks.get(chat.id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._chat_locks[chat.id] = lock
+        async with lock, self._slots:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# Пул соединений к api.telegram.org под параллельные отправки (рассылка до 30 в секунду)
+TG_CONNECTION_POOL_SIZE = int(os.getenv("TG_CONNECTION_POOL_SIZE", "256"))
+
+# Все тексты бота — HTML без превью ссылок; задаём один раз вместо kwargs в каждом вызове
+TG_DEFAULTS = Defaults(parse_mode=ParseMode.HTML, link_preview_options=LinkPreviewOptions(is_disabled=True))
+
+# Состояние рассылки и user_data переживают рестарт, если задан PERSISTENCE_FILE
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE", "").strip()
+# Брошенный диалог рассылки закрывается сам, чтобы не висел в памяти
+BROADCAST_CONV_TIMEOUT_SEC = int(os.getenv("BROADCAST_CONV_TIMEOUT_SEC", "600"))
+
+_app_builder = (
     Application.builder()
     .token(TELEGRAM_BOT_TOKEN)
-    .concurrent_updates(MAX_CONCURRENT_UPDATES)
-    .build()
+    .defaults(TG_DEFAULTS)
+    .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+    .connection_pool_size(TG_CONNECTION_POOL_SIZE)
+    .pool_timeout(5.0)
+    .connect_timeout(5.0)
+    .read_timeout(10.0)
+    .http_version("2")
 )
+if PERSISTENCE_FILE:
+    _app_builder.persistence(
+        PicklePersistence(
+            filepath=PERSISTENCE_FILE,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+        )
+    )
+telegram_app = _app_builder.build()
+
+# Кнопки меню: один хендлер и dict по callback_data вместо цепочки regex-паттернов
+MENU_CALLBACKS = {
+    "pay": on_pay,
+    "check": on_check,
+    "about": on_about,
+    "support": on_support,
+    "policies": on_policies,
+    "offer": on_offer,
+    "back": on_back,
+}
+
+
+async def on_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await MENU_CALLBACKS[update.callback_query.data](update, context)
+
 
 telegram_app.add_handler(CommandHandler("start", cmd_start))
-telegram_app.add_handler(CallbackQueryHandler(on_pay, pattern="^pay$"))
-telegram_app.add_handler(CallbackQueryHandler(on_check, pattern="^check$"))
-telegram_app.add_handler(CallbackQueryHandler(on_about, pattern="^about$"))
-telegram_app.add_handler(CallbackQueryHandler(on_support, pattern="^support$"))
-telegram_app.add_handler(CallbackQueryHandler(on_policies, pattern="^policies$"))
-telegram_app.add_handler(CallbackQueryHandler(on_offer, pattern="^offer$"))
-telegram_app.add_handler(CallbackQueryHandler(on_back, pattern="^(back)$"))
+# паттерн-callable: остальные callback_data (рассылка) проходят дальше к broadcast_conv
+telegram_app.add_handler(CallbackQueryHandler(on_menu_callback, pattern=MENU_CALLBACKS.__contains__))
 
 # Admin broadcast conversation (group 0)
 broadcast_conv = ConversationHandler(
@@ -879,83 +1400,131 @@ broadcast_conv = ConversationHandler(
     fallbacks=[CallbackQueryHandler(on_broadcast_cancel, pattern="^broadcast_cancel$")],
     per_user=True,
     per_chat=True,
+    conversation_timeout=BROADCAST_CONV_TIMEOUT_SEC,
+    name="broadcast",
+    persistent=bool(PERSISTENCE_FILE),
 )
 telegram_app.add_handler(broadcast_conv, group=0)
 
 # Email capture (group 1) — чтобы не мешать рассылке
-telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text_for_email), group=1)
+telegram_app.add_handler(
+    MessageHandler(filters.TEXT & ~filters.COMMAND & AwaitingEmailFilter(), on_text_for_email),
+    group=1,
+)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global WELCOME_IMAGE_BYTES, OFFERTA_BYTES
+    # В event loop запись лога только кладётся в очередь; вывод в stderr — в потоке QueueListener
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    log_listener = QueueListener(log_queue, stream_handler)
+    log_listener.start()
+    logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+    # httpx пишет INFO на каждый HTTP-запрос (Telegram/Supabase) — это шум
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    WELCOME_IMAGE_BYTES = read_asset(WELCOME_IMAGE_PATH)
+    OFFERTA_BYTES = read_asset(OFFERTA_FILE_PATH)
+
     await telegram_app.initialize()
     await telegram_app.start()
 
-    # ✅ self-heal webhook
+    # ✅ self-heal webhook: setWebhook идемпотентен — один вызов вместо getWebhookInfo + setWebhook
     try:
-        info = await telegram_app.bot.get_webhook_info()
-        if (not info.url) or (info.url != WEBHOOK_URL):
-            await telegram_app.bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True)
-        else:
-            await telegram_app.bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=False)
+        await set_webhook(drop_pending_updates=False)
     except Exception as ex:
-        print("[webhook setup] error:", repr(ex))
+        log.warning("[webhook setup] error: %r", ex)
 
     yield
 
     # ВАЖНО: НЕ delete_webhook() на Render — иначе после рестартов Telegram может "дергаться"
     try:
         await telegram_app.stop()
+        await flush_started()
         await telegram_app.shutdown()
+        await http_client.aclose()
     except Exception as ex:
-        print("[app stop/shutdown] error:", repr(ex))
+        log.warning("[app stop/shutdown] error: %r", ex)
+    # Последняя запись (flush_started) уже дождалась; event loop не ждёт зависшие потоки
+    DB_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    log_listener.stop()
+
+
+# Пинги Render/UptimeRobot на / и /health отвечаем прямо на уровне ASGI —
+# мимо роутинга, валидации и сборки Response в FastAPI. Тела собираются один раз.
+def _static_json(payload: dict) -> tuple[list[tuple[bytes, bytes]], bytes]:
+    body = orjson.dumps(payload)
+    headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    return headers, body
 
 
-app = FastAPI(lifespan=lifespan)
+_FAST_PATHS: dict[str, tuple[list[tuple[bytes, bytes]], bytes]] = {
+    "/": _static_json({"ok": True, "service": "tg-payment-bot", "payments_enabled": PAYMENTS_ENABLED}),
+    "/health": _static_json({"ok": True}),
+}
 
 
-@app.get("/")
-async def root():
-    return {"ok": True, "service": "tg-payment-bot", "payments_enabled": PAYMENTS_ENABLED}
+class FastPathMiddleware:
+    def __init__(self, app):
+        self.app = app
 
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            hit = _FAST_PATHS.get(scope["path"])
+            if hit is not None:
+                headers, body = hit
+                await send({"type": "http.response.start", "status": 200, "headers": headers})
+                await send({"type": "http.response.body", "body": body if scope["method"] == "GET" else b""})
+                return
+        await self.app(scope, receive, send)
 
-@app.get("/health")
-async def health():
-    return {"ok": True}
 
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+app.add_middleware(FastPathMiddleware)
 
-@app.head("/")
-async def root_head():
-    return Response(status_code=200)
+# Ответ вебхуку без состояния — один объект на все запросы
+OK_RESPONSE = Response(status_code=200)
 
 
-@app.head("/health")
-async def health_head():
-    return Response(status_code=200)
+# Отладочный эндпоинт публичный — в Bot API ходим не чаще раза в WEBHOOK_INFO_TTL_SEC
+WEBHOOK_INFO_TTL_SEC = 5.0
+_webhook_info_cache: tuple[float, dict] | None = None
 
 
 @app.get("/debug/webhook")
 async def debug_webhook():
+    global _webhook_info_cache
+    now = time.monotonic()
+    if _webhook_info_cache is not None and now - _webhook_info_cache[0] < WEBHOOK_INFO_TTL_SEC:
+        return _webhook_info_cache[1]
     info = await telegram_app.bot.get_webhook_info()
-    return {
+    data = {
         "expected": WEBHOOK_URL,
         "current_url": info.url,
         "pending_update_count": info.pending_update_count,
         "last_error_date": info.last_error_date,
         "last_error_message": info.last_error_message,
     }
+    _webhook_info_cache = (now, data)
+    return data
 
 
 @app.get("/debug/reset-webhook")
 async def debug_reset_webhook():
-    await telegram_app.bot.set_webhook(url=WEBHOOK_URL, drop_pending_updates=True)
+    global _webhook_info_cache
+    await set_webhook(drop_pending_updates=True)
+    _webhook_info_cache = None
     return {"ok": True, "set_to": WEBHOOK_URL}
 
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request) -> Response:
-    data = await request.json()
+    data = orjson.loads(await request.body())
     update = Update.de_json(data, telegram_app.bot)
-    await telegram_app.process_update(update)
-    return Response(status_code=200)
+    # Отвечаем Telegram сразу; обработку берут воркеры PTB из update_queue
+    telegram_app.update_queue.put_nowait(update)
+    return OK_RESPONSE
 